@@ -1,26 +1,136 @@
 #!/usr/bin/env python
 import logging
+import marshal
 import os
+import pickle
+import sqlite3
 import sys
+import time
 
 from sliderepl import Deck
+from sliderepl import core
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def _percentile(values, pct):
+    """Return the nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
 
 
 class SADeck(Deck):
-    expose = Deck.expose + ('echo',)
+    expose = Deck.expose + ('echo', 'explain', 'timing')
+
+    _slide_attrs = ('title', 'intro', 'lines', 'no_exec', 'no_clear',
+                    'no_echo', 'no_return', 'init')
 
-    def __init__(self, path=None, echo_on=True, **options):
+    # plain data in the slide namespace is copied into checkpoints;
+    # everything else is restored by reference.
+    _checkpoint_types = (bool, int, float, str, bytes, type(None),
+                         list, tuple, dict, set, frozenset)
+
+    def __init__(self, path=None, echo_on=True, cache_slides=True,
+                        checkpoints=True, **options):
         Deck.__init__(self, path, **options)
         self.start_with_echo = echo_on
+        self.cache_slides = cache_slides
+        self.checkpoints = checkpoints
+        self._timings = {}
+        self._checkpoints = {}
+        self._explain = False
+
+    @classmethod
+    def from_path(cls, path, **options):
+        """Create a Deck from a file, using the slide cache if possible."""
+
+        deck = cls(path, **options)
+        if not deck.cache_slides:
+            cls._slides_from_file(path, deck)
+        elif not deck._load_slide_cache():
+            cls._slides_from_file(path, deck)
+            deck._save_slide_cache()
+        return deck.slides and deck or None
+
+    @property
+    def _slide_cache_path(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                            ".slidecache",
+                            os.path.basename(self.path) + ".cache")
+
+    def _load_slide_cache(self):
+        try:
+            with open(self._slide_cache_path, 'rb') as fh:
+                cached = marshal.load(fh)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+
+        if cached.get('version') != sys.version:
+            return False
+        for fname, mtime in cached['files'].items():
+            if not os.path.exists(fname) or \
+                    os.path.getmtime(fname) != mtime:
+                return False
+
+        for data in cached['slides']:
+            slide = self.Slide(self, file=data['file'], index=data['index'])
+            slide.codeblocks = [(list(display), co)
+                                for display, co in data['codeblocks']]
+            for attr in self._slide_attrs:
+                if attr in data:
+                    setattr(slide, attr, data[attr])
+            if slide.init:
+                self.init_slide = slide
+            else:
+                self.slides.append(slide)
+        return True
+
+    def _save_slide_cache(self):
+        slides = list(self.slides)
+        if self.init_slide:
+            slides.insert(0, self.init_slide)
+
+        files = set([os.path.abspath(self.path)])
+        cached_slides = []
+        for slide in slides:
+            files.add(os.path.abspath(slide.file))
+            data = {'file': slide.file, 'index': slide.index,
+                    'codeblocks': [(list(display), co)
+                                   for display, co in slide.codeblocks]}
+            for attr in self._slide_attrs:
+                if hasattr(slide, attr):
+                    data[attr] = getattr(slide, attr)
+            cached_slides.append(data)
+
+        cached = {
+            'version': sys.version,
+            'files': dict((fname, os.path.getmtime(fname))
+                          for fname in files),
+            'slides': cached_slides,
+        }
+        cache_path = self._slide_cache_path
+        try:
+            if not os.path.exists(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            with open(cache_path, 'wb') as fh:
+                marshal.dump(cached, fh)
+        except (IOError, OSError):
+            pass
 
     def start(self):
+        stream = self.highlight_stdout
+        if callable(stream):
+            stream = stream("sql")
         logging_config = {'format': '[SQL]: %(message)s',
-                          'stream': self.highlight_stdout("sql")}
+                          'stream': stream}
         logging.basicConfig(**logging_config)
 
         sys.path.insert(0, os.path.dirname(self.path))
 
-        self._set_echo(self.start_with_echo and 'on' or 'off')
+        self._set_echo(self.start_with_echo)
+        self._start_timing()
 
     def echo(self):
         """Toggle SQL echo on or off."""
@@ -35,4 +145,236 @@ class SADeck(Deck):
             log.setLevel(logging.WARN)
         print("%% SQL echo is now %s" % (self._echo and 'ON' or 'OFF'))
 
+    def explain(self):
+        """Toggle EXPLAIN QUERY PLAN output on or off."""
+        self._explain = not self._explain
+        print("%% EXPLAIN QUERY PLAN is now %s" %
+                    (self._explain and 'ON' or 'OFF'))
+
+    def _explain_statement(self, conn, statement, parameters):
+        words = statement.split(None, 1)
+        if not words or words[0].upper() not in ('SELECT', 'UPDATE',
+                                                 'DELETE', 'WITH'):
+            return
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plan = cursor.fetchall()
+        except Exception as err:
+            print("[PLAN]: couldn't explain: %s" % err)
+            return
+        finally:
+            cursor.close()
+
+        depth = {0: -1}
+        for id_, parent, notused, detail in plan:
+            depth[id_] = depth.get(parent, -1) + 1
+            upper = detail.upper()
+            if upper.startswith("SCAN") and "INDEX" not in upper:
+                flag = "   <-- full table scan"
+            elif "TEMP B-TREE" in upper:
+                flag = "   <-- temp b-tree sort"
+            else:
+                flag = ""
+            print("[PLAN]: %s%s%s" % ("  " * depth[id_], detail, flag))
+
+    def timing(self):
+        """Show SQL latency per slide and for the deck.
+
+        "dml rows" counts rows affected by INSERT, UPDATE and DELETE;
+        the DBAPI doesn't report a rowcount for SELECT.
+
+        """
+        if not self._timings:
+            print("% No SQL statements have been timed yet.")
+            return
+
+        header = "%-8s %6s %8s %6s %10s %10s %10s %10s" % (
+                    "slide", "stmts", "dml rows", "params", "total ms",
+                    "p50 ms", "p95 ms", "max ms")
+        print(header)
+        print("-" * len(header))
+        everything = []
+        for num in sorted(self._timings):
+            records = self._timings[num]
+            everything.extend(records)
+            self._print_timing_row(num or "init", records)
+        print("-" * len(header))
+        self._print_timing_row("deck", everything)
+
+        by_statement = {}
+        for statement, elapsed, rowcount, paramsets in everything:
+            key = " ".join(statement.split())
+            by_statement[key] = by_statement.get(key, 0) + elapsed
+        print("")
+        print("% Slowest statements by total time:")
+        for key, elapsed in sorted(by_statement.items(),
+                                    key=lambda item: item[1],
+                                    reverse=True)[0:5]:
+            print("%10.3f ms  %s" % (elapsed * 1000, key[0:60]))
+
+    def _print_timing_row(self, label, records):
+        elapsed = sorted(record[1] * 1000 for record in records)
+        print("%-8s %6d %8d %6d %10.3f %10.3f %10.3f %10.3f" % (
+                label, len(records),
+                sum(max(record[2], 0) for record in records),
+                sum(record[3] for record in records),
+                sum(elapsed), _percentile(elapsed, 50),
+                _percentile(elapsed, 95), elapsed[-1]))
+
+    def _start_timing(self):
+        event.listen(Engine, "before_cursor_execute",
+                                self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute",
+                                self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement,
+                                parameters, context, executemany):
+        if self._explain and not executemany and \
+                conn.dialect.name == 'sqlite':
+            self._explain_statement(conn, statement, parameters)
+        conn.info.setdefault('sadeck_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement,
+                                parameters, context, executemany):
+        elapsed = time.time() - conn.info['sadeck_start_time'].pop(-1)
+        paramsets = executemany and len(parameters) or 1
+        self._timings.setdefault(self.current, []).append(
+                (statement, elapsed, cursor.rowcount, paramsets))
+
+    def prev(self):
+        """Advance to the previous slide."""
+
+        self._restore_checkpoint(self.current - 2)
+        Deck.prev(self)
+
+    def goto(self, slide_number):
+        """goto slide <number>"""
+
+        if str(slide_number).isdigit() and \
+                1 <= int(slide_number) <= self.current:
+            self._restore_checkpoint(int(slide_number) - 1)
+        Deck.goto(self, slide_number)
+
+    def _do_slide(self, num, run=True, echo=True):
+        Deck._do_slide(self, num, run=run, echo=echo)
+        slide = self.slides[num - 1]
+        if run == 'force' or \
+                (run and not (echo and getattr(slide, 'no_exec', False))):
+            self._save_checkpoint(num)
+
+    def _save_checkpoint(self, num):
+        """Record the namespace and SQLite databases as of slide ``num``."""
+
+        if not self.checkpoints:
+            return
+
+        environ = dict(core.environ)
+        data = dict((key, value) for key, value in environ.items()
+                    if type(value) in self._checkpoint_types)
+        try:
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = None
+
+        databases = []
+        for value in environ.values():
+            if isinstance(value, Engine) and value.dialect.name == 'sqlite':
+                copy = self._copy_sqlite(value, None)
+                if copy is None:
+                    # a database that can't be copied would come back
+                    # out of step with the namespace; skip this one
+                    self._checkpoints.pop(num, None)
+                    return
+                databases.append((value, copy))
+
+        self._checkpoints[num] = (environ, data, databases)
+
+    def _restore_checkpoint(self, num):
+        """Put the namespace and SQLite databases back as of slide ``num``.
+
+        Returns False if there's no checkpoint, or a database can't be
+        restored right now, in which case navigation falls back to
+        re-running slides as usual.
+
+        Only plain data is copied; everything else, including Sessions
+        and mapped objects, is restored by reference.  A Session's
+        identity map therefore reflects the latest slide run, and may
+        not match the database once it's put back.
+
+        Names defined after the checkpoint are left in place rather than
+        removed: MetaData and declarative classes are restored by
+        reference too and still hold the tables those later slides
+        defined, so a slide that redefines one fails as it would
+        without checkpoints, and later slides keep the names they use.
+
+        """
+        if num not in self._checkpoints:
+            return False
+
+        environ, data, databases = self._checkpoints[num]
+        for engine, copy in databases:
+            busy = self._sqlite_busy(engine)
+            if busy:
+                print("%% Couldn't restore database %s: %s" %
+                            (engine.url, busy))
+                return False
+
+        core.environ.update(environ)
+        if data is not None:
+            core.environ.update(pickle.loads(data))
+
+        for engine, copy in databases:
+            self._copy_sqlite(engine, copy)
+        return True
+
+    def _sqlite_busy(self, engine):
+        """Return why an engine's database can't be written over now,
+        or None."""
+
+        conn = engine.pool.connect()
+        try:
+            if getattr(conn.connection, 'in_transaction', False):
+                return "transaction in progress"
+            # fails if another connection holds a lock, which would
+            # otherwise leave the backup API retrying forever
+            conn.connection.execute("BEGIN IMMEDIATE")
+            conn.connection.execute("ROLLBACK")
+            return None
+        except sqlite3.Error as err:
+            return str(err)
+        finally:
+            conn.close()
+
+    def _copy_sqlite(self, engine, target):
+        """Copy an engine's database out to a new in-memory database,
+        or back in from ``target``, using the sqlite3 backup API.
+
+        The connection comes from ``pool.connect()``, which on a
+        ``sqlite://`` engine hands back the very connection a Session
+        or Connection may already have checked out; closing it then
+        leaves that checkout alone rather than rolling it back.
+
+        """
+        conn = engine.pool.connect()
+        try:
+            if not hasattr(conn.connection, 'backup'):
+                return None
+            if target is None:
+                # the backup API waits forever on a database with an
+                # uncommitted write on the same connection
+                if getattr(conn.connection, 'in_transaction', False):
+                    return None
+                copy = sqlite3.connect(":memory:", check_same_thread=False)
+                conn.connection.backup(copy)
+                return copy
+            else:
+                target.backup(conn.connection)
+                return target
+        except sqlite3.Error as err:
+            print("%% Couldn't checkpoint database %s: %s" % (engine.url, err))
+            return None
+        finally:
+            conn.close()
+
 deck = SADeck
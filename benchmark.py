@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+"""Run the slide decks as a benchmark.
+
+Each deck is executed end to end several times, each time in a fresh
+interpreter, using the same SADeck that ``sliderepl`` uses.  Every slide
+is timed and its SQL statements counted; the peak RSS of each run is
+recorded as well.  The results are written as JSON or CSV, and may be
+compared against a previously saved report::
+
+    python benchmark.py --runs 5 --output baseline.json
+    python benchmark.py --runs 5 --baseline baseline.json
+
+The second form exits with a non-zero status if any slide got slower
+than the baseline by more than ``--threshold``, or raised different
+exceptions than it did in the baseline.  Exceptions raised by slides
+are recorded in the report, since sliderepl prints and carries on
+past them.
+
+``--sqlite-profiles`` instead measures statement throughput of the
+01_engine_usage.py and 03_sql_expressions.py workloads against a file
+database under each of the SQLite profiles in ``coretools``::
+
+    python benchmark.py --sqlite-profiles --rows 5000
+
+``--streaming`` compares the peak RSS of scanning a large ``user``
+table with fetchall()/Query.all() against the batched iteration of
+``coretools.stream_rows()`` and ``ormtools.stream()``, each in a fresh
+interpreter::
+
+    python benchmark.py --streaming --rows 1000000
+
+"""
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+DECKS = [
+    "01_engine_usage.py",
+    "02_metadata.py",
+    "03_sql_expressions.py",
+    "04_orm.py",
+]
+
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes on OSX, kilobytes elsewhere
+        rss = rss // 1024
+    return rss
+
+
+def run_deck(path):
+    """Run every slide of a deck in this interpreter, return timings."""
+
+    from sliderepl import core
+
+    locals_ = {}
+    exec(compile(open(os.path.join(here, "_config.py")).read(),
+                        "_config.py", 'exec'), locals_)
+
+    # sliderepl reports a failing slide with traceback.print_exc()
+    errors = []
+
+    def record_exc(*arg, **kw):
+        type_, value = sys.exc_info()[0:2]
+        errors.append(
+            traceback.format_exception_only(type_, value)[-1].strip())
+
+    real_stdout, print_exc = sys.stdout, traceback.print_exc
+    sys.stdout = open(os.devnull, "w")
+    traceback.print_exc = record_exc
+    try:
+        deck = locals_['deck'].from_path(path, echo_on=False,
+                                         checkpoints=False, color='never')
+        deck.start()
+        core.environ = {'__name__': '__console__'}
+        if deck.init_slide:
+            for display, co in deck.init_slide.codeblocks:
+                core.exec_(co, core.environ)
+
+        slides = []
+        while deck.current < len(deck.slides):
+            del errors[:]
+            now = time.time()
+            deck._next(run='force')
+            elapsed = time.time() - now
+            slide = deck.slides[deck.current - 1]
+            slides.append({
+                "slide": deck.current,
+                "title": slide.title,
+                "ms": elapsed * 1000,
+                "statements": len(deck._timings.get(deck.current, ())),
+                "errors": list(errors),
+            })
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+        traceback.print_exc = print_exc
+
+    return {"slides": slides, "peak_rss_kb": _peak_rss_kb()}
+
+
+def _run_child(deck_name):
+    proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                        "--child", deck_name],
+                cwd=here, stdout=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise Exception("benchmark of %s failed with status %s" %
+                                (deck_name, proc.returncode))
+    return json.loads(out.decode("utf-8"))
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def benchmark(deck_names, runs):
+    """Run each deck ``runs`` times and summarize per slide."""
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "runs": runs,
+        "decks": {},
+    }
+    for deck_name in deck_names:
+        results = [_run_child(deck_name) for _ in range(runs)]
+        slides = []
+        for by_run in zip(*[result["slides"] for result in results]):
+            times = [slide["ms"] for slide in by_run]
+            slides.append({
+                "slide": by_run[0]["slide"],
+                "title": by_run[0]["title"],
+                "median_ms": _median(times),
+                "min_ms": min(times),
+                "max_ms": max(times),
+                "statements": by_run[0]["statements"],
+                "errors": sorted(set(error for slide in by_run
+                                     for error in slide["errors"])),
+            })
+        rss = [result["peak_rss_kb"] for result in results
+                    if result["peak_rss_kb"] is not None]
+        report["decks"][deck_name] = {
+            "total_ms": sum(slide["median_ms"] for slide in slides),
+            "statements": sum(slide["statements"] for slide in slides),
+            "peak_rss_kb": rss and max(rss) or None,
+            "errors": sum(len(slide["errors"]) for slide in slides),
+            "slides": slides,
+        }
+    return report
+
+
+def compare(report, baseline, threshold, min_delta_ms):
+    """Return a list of slides slower than the baseline."""
+
+    regressions = []
+    decks = baseline.get("decks", {})
+    for deck_name, deck in report.get("decks", {}).items():
+        if deck_name not in decks:
+            continue
+        previous = dict((slide["slide"], slide)
+                        for slide in decks[deck_name]["slides"])
+        for slide in deck["slides"]:
+            before = previous.get(slide["slide"])
+            if before is None:
+                continue
+            delta = slide["median_ms"] - before["median_ms"]
+            if delta > min_delta_ms and \
+                    slide["median_ms"] > before["median_ms"] * (1 + threshold):
+                regressions.append(
+                    (deck_name, slide["slide"],
+                        before["median_ms"], slide["median_ms"]))
+    return regressions
+
+
+def changed_errors(report, baseline):
+    """Return slides whose exceptions differ from the baseline's."""
+
+    changed = []
+    decks = baseline.get("decks", {})
+    for deck_name, deck in report.get("decks", {}).items():
+        if deck_name not in decks:
+            continue
+        previous = dict((slide["slide"], slide)
+                        for slide in decks[deck_name]["slides"])
+        for slide in deck["slides"]:
+            before = previous.get(slide["slide"])
+            if before is None or "errors" not in before:
+                continue
+            if before["errors"] != slide["errors"]:
+                changed.append((deck_name, slide["slide"],
+                                before["errors"], slide["errors"]))
+    return changed
+
+
+def engine_usage_workload(engine, rows):
+    """The statements of 01_engine_usage.py, scaled up to ``rows``.
+
+    Returns the number of statements run.
+
+    """
+    engine.execute("""
+        create table employee (
+            emp_id integer primary key,
+            emp_name varchar
+        )
+    """)
+    engine.execute("""
+        create table employee_of_month (
+            emp_id integer primary key,
+            emp_name varchar
+        )
+    """)
+    for i in range(rows):
+        engine.execute("insert into employee (emp_name) values (:emp_name)",
+                        emp_name="employee %d" % i)
+    for i in range(rows):
+        engine.execute("select emp_id, emp_name from "
+                        "employee where emp_id=:emp_id",
+                        emp_id=i + 1).fetchall()
+    with engine.begin() as conn:
+        conn.execute("insert into employee (emp_name) values (:emp_name)",
+                        emp_name="mary")
+        conn.execute("update employee_of_month set emp_name = :emp_name",
+                        emp_name="mary")
+    return rows * 2 + 4
+
+
+def sql_expressions_workload(engine, rows):
+    """The statements of 03_sql_expressions.py, scaled up to ``rows``.
+
+    Returns the number of statements run.
+
+    """
+    from sqlalchemy import MetaData, Table, Column, Integer, String, \
+                ForeignKey, select, func
+
+    metadata = MetaData()
+    user_table = Table('user', metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('username', String(50)),
+                    Column('fullname', String(50))
+                )
+    address_table = Table("address", metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('user_id', Integer, ForeignKey('user.id'),
+                                                    nullable=False),
+                    Column('email_address', String(100), nullable=False)
+                )
+    metadata.create_all(engine)
+
+    statements = 0
+    with engine.connect() as conn:
+        for i in range(rows):
+            conn.execute(user_table.insert(),
+                        username="user%d" % i, fullname="User %d" % i)
+        conn.execute(address_table.insert(), [
+                        {"user_id": i + 1,
+                            "email_address": "user%d@example.com" % i}
+                        for i in range(rows)])
+        statements += rows + 1
+
+        address_subq = select([
+                            address_table.c.user_id,
+                            func.count(address_table.c.id).label('count')
+                        ]).group_by(address_table.c.user_id).alias()
+        username_plus_count = select([
+                            user_table.c.username,
+                            address_subq.c.count
+                        ]).select_from(
+                            user_table.join(address_subq)
+                        ).order_by(user_table.c.username)
+        for i in range(10):
+            conn.execute(username_plus_count).fetchall()
+        for i in range(rows):
+            conn.execute(select([user_table]).
+                            where(user_table.c.username == "user%d" % i)
+                        ).fetchall()
+        statements += rows + 10
+
+        for i in range(0, rows, 10):
+            conn.execute(address_table.update().
+                    values(email_address="changed%d@example.com" % i).
+                    where(address_table.c.user_id == i + 1))
+            conn.execute(address_table.delete().
+                    where(address_table.c.user_id == i + 2))
+            statements += 2
+    return statements
+
+
+WORKLOADS = [
+    ("01_engine_usage", engine_usage_workload),
+    ("03_sql_expressions", sql_expressions_workload),
+]
+
+
+def benchmark_sqlite_profiles(rows):
+    """Run each workload on a fresh file database under each profile."""
+
+    from coretools import SQLITE_PROFILES, create_sqlite_engine
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "rows": rows,
+        "profiles": {},
+    }
+    for profile in ["default"] + sorted(SQLITE_PROFILES):
+        results = report["profiles"][profile] = {}
+        for name, workload in WORKLOADS:
+            tmpdir = tempfile.mkdtemp()
+            try:
+                engine = create_sqlite_engine(
+                            "sqlite:///%s" % os.path.join(tmpdir, "bench.db"),
+                            profile=profile != "default" and profile or None)
+                now = time.time()
+                statements = workload(engine, rows)
+                elapsed = time.time() - now
+                engine.dispose()
+            finally:
+                shutil.rmtree(tmpdir)
+            results[name] = {
+                "seconds": elapsed,
+                "statements": statements,
+                "per_second": statements / elapsed,
+            }
+    return report
+
+
+STREAM_MODES = ["core_fetchall", "core_stream", "orm_all", "orm_stream"]
+
+
+def _stream_tables():
+    from sqlalchemy import Column, Integer, String
+    from sqlalchemy.ext.declarative import declarative_base
+
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'user'
+
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        fullname = Column(String)
+
+    return User
+
+
+def scan(mode, db_path):
+    """Read every row of the ``user`` table in one of STREAM_MODES."""
+
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.orm import Session
+    from coretools import stream_rows
+    from ormtools import stream
+
+    User = _stream_tables()
+    engine = create_engine("sqlite:///%s" % db_path)
+    stmt = select([User.__table__])
+
+    now = time.time()
+    count = 0
+    if mode == "core_fetchall":
+        for row in engine.execute(stmt).fetchall():
+            count += 1
+    elif mode == "core_stream":
+        for row in stream_rows(engine, stmt):
+            count += 1
+    elif mode == "orm_all":
+        for user in Session(bind=engine).query(User).all():
+            count += 1
+    elif mode == "orm_stream":
+        for user in stream(Session(bind=engine).query(User)):
+            count += 1
+    return {"rows": count, "seconds": time.time() - now,
+            "peak_rss_kb": _peak_rss_kb()}
+
+
+def benchmark_streaming(rows):
+    """Scan a table of ``rows`` rows in each mode, in fresh interpreters."""
+
+    from sqlalchemy import create_engine
+    from coretools import bulk_insert
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "rows": rows,
+        "streaming": {},
+    }
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, "stream.db")
+        engine = create_engine("sqlite:///%s" % db_path)
+        User = _stream_tables()
+        User.metadata.create_all(engine)
+        bulk_insert(engine, User.__table__,
+                    ({"name": "user%d" % i, "fullname": "User Number %d" % i}
+                        for i in range(rows)), chunk_size=10000)
+        engine.dispose()
+
+        for mode in STREAM_MODES:
+            proc = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__),
+                            "--stream-child", mode, db_path],
+                        cwd=here, stdout=subprocess.PIPE)
+            out, err = proc.communicate()
+            if proc.returncode != 0:
+                raise Exception("streaming benchmark %s failed with "
+                                "status %s" % (mode, proc.returncode))
+            report["streaming"][mode] = json.loads(out.decode("utf-8"))
+    finally:
+        shutil.rmtree(tmpdir)
+    return report
+
+
+def write_json(report, fh):
+    json.dump(report, fh, indent=2, sort_keys=True)
+    fh.write("\n")
+
+
+def write_csv(report, fh):
+    writer = csv.writer(fh)
+    if "profiles" in report:
+        writer.writerow(["profile", "workload", "seconds", "statements",
+                            "per_second"])
+        for profile in sorted(report["profiles"]):
+            for name, result in sorted(report["profiles"][profile].items()):
+                writer.writerow([profile, name, "%.3f" % result["seconds"],
+                            result["statements"],
+                            "%.1f" % result["per_second"]])
+        return
+    if "streaming" in report:
+        writer.writerow(["mode", "rows", "seconds", "peak_rss_kb"])
+        for mode in STREAM_MODES:
+            result = report["streaming"][mode]
+            writer.writerow([mode, result["rows"],
+                            "%.3f" % result["seconds"],
+                            result["peak_rss_kb"]])
+        return
+
+    writer.writerow(["deck", "slide", "title", "median_ms", "min_ms",
+                        "max_ms", "statements", "peak_rss_kb", "errors"])
+    for deck_name in sorted(report["decks"]):
+        deck = report["decks"][deck_name]
+        for slide in deck["slides"]:
+            writer.writerow([deck_name, slide["slide"], slide["title"] or "",
+                            "%.3f" % slide["median_ms"],
+                            "%.3f" % slide["min_ms"],
+                            "%.3f" % slide["max_ms"],
+                            slide["statements"], deck["peak_rss_kb"],
+                            "; ".join(slide["errors"])])
+
+
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("decks", nargs="*", default=DECKS,
+                        help="deck files to run (default: all)")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="number of fresh-interpreter runs per deck")
+    parser.add_argument("--format", choices=("json", "csv"), default="json",
+                        help="report format")
+    parser.add_argument("--output", help="write the report to this file")
+    parser.add_argument("--baseline",
+                        help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fraction a slide may slow down before it "
+                        "counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="ignore slowdowns smaller than this")
+    parser.add_argument("--sqlite-profiles", action="store_true",
+                        help="measure throughput under each SQLite "
+                        "profile instead of running the decks")
+    parser.add_argument("--streaming", action="store_true",
+                        help="measure peak memory of buffered versus "
+                        "streamed scans instead of running the decks")
+    parser.add_argument("--rows", type=int, default=None,
+                        help="rows per workload for --sqlite-profiles "
+                        "(default 2000) or --streaming (default 1000000)")
+    parser.add_argument("--child", help="internal: run one deck and exit")
+    parser.add_argument("--stream-child", nargs=2,
+                        help="internal: run one streaming scan and exit")
+
+    options = parser.parse_args(argv)
+    if options.baseline and (options.sqlite_profiles or options.streaming):
+        parser.error("--baseline only applies when running the decks")
+
+    if options.child:
+        json.dump(run_deck(options.child), sys.stdout)
+        return 0
+
+    if options.stream_child:
+        json.dump(scan(*options.stream_child), sys.stdout)
+        return 0
+
+    if options.sqlite_profiles:
+        report = benchmark_sqlite_profiles(options.rows or 2000)
+    elif options.streaming:
+        report = benchmark_streaming(options.rows or 1000000)
+    else:
+        report = benchmark(options.decks, options.runs)
+
+    writer = options.format == "csv" and write_csv or write_json
+    if options.output:
+        with open(options.output, "w") as fh:
+            writer(report, fh)
+    else:
+        writer(report, sys.stdout)
+
+    for profile in sorted(report.get("profiles", ())):
+        for name, result in sorted(report["profiles"][profile].items()):
+            sys.stderr.write("%-12s %-20s %10.1f statements/sec\n" % (
+                    profile, name, result["per_second"]))
+
+    for mode in STREAM_MODES:
+        if mode in report.get("streaming", ()):
+            result = report["streaming"][mode]
+            sys.stderr.write("%-15s %10d rows %8.1f s %10s KB peak RSS\n" % (
+                    mode, result["rows"], result["seconds"],
+                    result["peak_rss_kb"]))
+
+    for deck_name in sorted(report.get("decks", ())):
+        deck = report["decks"][deck_name]
+        sys.stderr.write("%-25s %8.1f ms %5d statements %8s KB\n" % (
+                    deck_name, deck["total_ms"], deck["statements"],
+                    deck["peak_rss_kb"]))
+        for slide in deck["slides"]:
+            for error in slide["errors"]:
+                sys.stderr.write("  slide %d raised %s\n" % (
+                        slide["slide"], error))
+
+    if options.baseline:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(report, baseline, options.threshold,
+                                options.min_delta_ms)
+        for deck_name, num, before, after in regressions:
+            sys.stderr.write(
+                "REGRESSION: %s slide %d: %.3f ms -> %.3f ms\n" % (
+                        deck_name, num, before, after))
+        changed = changed_errors(report, baseline)
+        for deck_name, num, before, after in changed:
+            sys.stderr.write(
+                "ERRORS CHANGED: %s slide %d: %s -> %s\n" % (
+                        deck_name, num, before or "none", after or "none"))
+        if regressions or changed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
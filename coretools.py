@@ -0,0 +1,1051 @@
+"""Helpers for working with the Engine and SQL Expression Language
+at larger data volumes than the tutorial slides use.
+
+"""
+import base64
+import collections
+import datetime
+import decimal
+import hashlib
+import itertools
+import json
+import marshal
+import os
+import pickle
+import shutil
+import sqlite3
+import time
+import weakref
+
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm
+
+from sqlalchemy import Boolean, ForeignKeyConstraint, Index, MetaData, \
+                        Table, UniqueConstraint, and_, bindparam, \
+                        create_engine, event, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import ColumnElement, UnaryExpression, \
+                        UpdateBase, _clone
+from sqlalchemy.sql.util import find_tables
+
+
+def _table(connectable, table):
+    if isinstance(table, Table):
+        return table
+    return Table(table, MetaData(), autoload=True, autoload_with=connectable)
+
+
+def _begin(connectable):
+    if isinstance(connectable, Engine):
+        return connectable.begin()
+    else:
+        return _ConnectionTransaction(connectable)
+
+
+class _ConnectionTransaction(object):
+    """Context manager like Engine.begin() for an existing Connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.trans = self.conn.begin()
+        return self.conn
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.trans.commit()
+        else:
+            self.trans.rollback()
+
+
+# PRAGMA settings applied to each new SQLite connection, by profile name.
+# cache_size is negative to mean KiB rather than pages.
+SQLITE_PROFILES = {
+    # fast loading; a crash may lose the most recent transactions
+    'bulk_load': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -262144),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 268435456),
+    ],
+    # many readers; WAL lets them run alongside a writer
+    'read_heavy': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 1073741824),
+    ],
+    # every commit is on disk before it returns
+    'durable': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -16384),
+        ('temp_store', 'DEFAULT'),
+        ('mmap_size', 0),
+    ],
+}
+
+
+def apply_sqlite_profile(engine, profile):
+    """Apply the PRAGMAs of a named profile to every pooled connection.
+
+    The PRAGMAs are run from a pool "connect" event, so this should be
+    called before the engine first connects; connections already in
+    the pool aren't changed.
+
+    """
+    try:
+        pragmas = SQLITE_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown SQLite profile %r; expected one of %s" %
+                            (profile, ", ".join(sorted(SQLITE_PROFILES))))
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+    event.listen(engine, "connect", set_pragmas)
+    return engine
+
+
+def enable_sqlite_foreign_keys(engine):
+    """Have SQLite enforce FOREIGN KEY constraints, including their
+    ON DELETE and ON UPDATE actions, on every pooled connection.
+
+    SQLite leaves them off unless ``PRAGMA foreign_keys`` is set on
+    each connection; as with :func:`apply_sqlite_profile`, call this
+    before the engine first connects.
+
+    """
+    def set_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+    event.listen(engine, "connect", set_pragma)
+    return engine
+
+
+def create_sqlite_engine(url, profile=None, **kw):
+    """create_engine() for SQLite, optionally with a named profile."""
+
+    engine = create_engine(url, **kw)
+    if profile is not None:
+        apply_sqlite_profile(engine, profile)
+    return engine
+
+
+def chunks(rows, chunk_size):
+    """Break an iterable into lists of at most ``chunk_size`` items."""
+
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_rows(connectable, stmt, batch_size=1000, **params):
+    """Execute a statement and yield its rows ``batch_size`` at a time.
+
+    Rows are fetched with fetchmany() rather than fetchall(), and the
+    ``stream_results`` option is set, so a DBAPI that supports server
+    side cursors, as well as SQLite, never holds more than one batch in
+    memory on the Python side.
+
+    """
+    result = connectable.execution_options(stream_results=True).\
+                                execute(stmt, **params)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def bulk_insert(connectable, table, rows, chunk_size=1000, progress=None):
+    """INSERT a stream of rows using one executemany() per chunk.
+
+    :param connectable: an Engine or Connection.
+    :param table: a Table, or the name of a table to be reflected,
+     e.g. ``"employee"``.
+    :param rows: any iterable of dictionaries, including a generator;
+     it's consumed ``chunk_size`` rows at a time.
+    :param chunk_size: rows per executemany(); each chunk is run
+     in its own transaction.
+    :param progress: optional callable, called after each chunk is
+     committed with the total number of rows inserted so far.
+
+    Returns the total number of rows inserted.
+
+    """
+    table = _table(connectable, table)
+    stmt = table.insert()
+    total = 0
+    for chunk in chunks(rows, chunk_size):
+        with _begin(connectable) as conn:
+            conn.execute(stmt, chunk)
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    return total
+
+
+def _key_columns(table, key):
+    if key is None:
+        return list(table.primary_key.columns)
+    if isinstance(key, str):
+        key = [key]
+    return [table.c[name] for name in key]
+
+
+def _key_criterion(columns):
+    return and_(*[col == bindparam('b_%s' % col.key) for col in columns])
+
+
+def _key_params(row, columns):
+    params = dict(('b_%s' % col.key, row[col.key]) for col in columns)
+    for name, value in row.items():
+        if name not in params and \
+                not any(col.key == name for col in columns):
+            params[name] = value
+    return params
+
+
+def bulk_update(connectable, table, rows, key=None, chunk_size=1000,
+                    progress=None):
+    """UPDATE many rows by key using one executemany() per chunk.
+
+    Each row is a dictionary of the key columns and the new values,
+    e.g. ``{"id": 5, "email_address": "jack@msn.com"}``.  They're run
+    as::
+
+        UPDATE address SET email_address=? WHERE address.id = ?
+
+    with the key values bound as ``b_<column>``.  Rows which set
+    different columns go in separate executemany() calls.
+
+    :param key: name or list of names of the key columns; defaults
+     to the primary key.
+
+    The other arguments are as for :func:`bulk_insert`.  Returns the
+    total number of rows matched.  Raises ValueError for a row that
+    has nothing but key columns, or names a column the table doesn't
+    have.
+
+    """
+    table = _table(connectable, table)
+    columns = _key_columns(table, key)
+    stmt = table.update().where(_key_criterion(columns))
+    total = matched = 0
+    for chunk in chunks(rows, chunk_size):
+        groups = collections.OrderedDict()
+        for row in chunk:
+            unknown = sorted(name for name in row if name not in table.c)
+            if unknown:
+                raise ValueError("Row %r names unknown column(s) %s" %
+                                 (row, ", ".join(unknown)))
+            params = _key_params(row, columns)
+            if len(params) == len(columns):
+                raise ValueError("Row %r has no values to update besides "
+                                 "its key" % (row, ))
+            groups.setdefault(tuple(sorted(params)), []).append(params)
+        with _begin(connectable) as conn:
+            for params in groups.values():
+                matched += conn.execute(stmt, params).rowcount
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    return matched
+
+
+def bulk_delete(connectable, table, rows, key=None, chunk_size=1000,
+                    progress=None):
+    """DELETE many rows by key using one executemany() per chunk.
+
+    Each row is a dictionary of the key columns, e.g. ``{"id": 5}``;
+    other keys are ignored.  Returns the total number of rows deleted.
+    The other arguments are as for :func:`bulk_update`.
+
+    """
+    table = _table(connectable, table)
+    columns = _key_columns(table, key)
+    stmt = table.delete().where(_key_criterion(columns))
+    total = deleted = 0
+    for chunk in chunks(rows, chunk_size):
+        params = [dict(('b_%s' % col.key, row[col.key]) for col in columns)
+                  for row in chunk]
+        with _begin(connectable) as conn:
+            deleted += conn.execute(stmt, params).rowcount
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    return deleted
+
+
+class CoalescingEngine(object):
+    """Wrap an Engine so that autocommitting statements share commits.
+
+    Statements passed to :meth:`execute` run on a single Connection inside
+    a transaction.  Those which :meth:`.Engine.execute` would have
+    autocommitted, such as INSERT and UPDATE, are counted, and the
+    transaction is committed once ``max_statements`` of them have
+    accumulated or ``max_seconds`` have passed since the batch started,
+    whichever comes first.  The time bound is checked as each statement
+    arrives; there's no background thread.
+
+    :meth:`flush` commits whatever is pending and is the durability
+    barrier; :meth:`close` flushes and releases the connection.  Other
+    Engine methods, like ``connect()``, pass through to the wrapped
+    Engine and don't see uncommitted statements - call :meth:`flush`
+    first.  With SQLite, a pending batch also holds the database lock.
+
+    """
+
+    def __init__(self, engine, max_statements=100, max_seconds=1.0):
+        self.engine = engine
+        self.max_statements = max_statements
+        self.max_seconds = max_seconds
+        self.pending = 0
+        self._conn = None
+        self._trans = None
+        self._started = None
+
+    def execute(self, statement, *multiparams, **params):
+        if self._conn is None:
+            self._conn = self.engine.connect()
+        if self._trans is None:
+            self._trans = self._conn.begin()
+            self._started = time.time()
+
+        result = self._conn.execute(statement, *multiparams, **params)
+        if result.context.should_autocommit:
+            self.pending += 1
+            if self.pending >= self.max_statements or \
+                    time.time() - self._started >= self.max_seconds:
+                self.flush()
+        return result
+
+    def flush(self):
+        """Commit all pending statements."""
+
+        if self._trans is not None:
+            self._trans.commit()
+            self._trans = None
+        self.pending = 0
+
+    def close(self):
+        """Commit all pending statements and release the connection."""
+
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is not None and self._trans is not None:
+            self._trans.rollback()
+            self._trans = None
+            self.pending = 0
+        self.close()
+
+    def __getattr__(self, key):
+        return getattr(self.engine, key)
+
+
+class SQLiteFixture(object):
+    """A schema plus seed data, built once and restored on demand.
+
+    ``build`` is a callable which receives an Engine and creates tables
+    and rows in it.  The first time the fixture is needed, ``build`` is
+    run against a new SQLite database at ``template_path``; after that,
+    :meth:`restore` copies the template over a target database, which
+    costs about as much as copying the file, regardless of how much work
+    ``build`` does.  A fingerprint of ``build``'s code is kept next to
+    the template, in ``<template_path>.build``, so that editing
+    ``build`` gets the template rebuilt::
+
+        def build(engine):
+            metadata.create_all(engine)
+            bulk_insert(engine, user_table, users)
+
+        fixture = SQLiteFixture("user.db.template", build)
+        fixture.restore("some.db")          # a file, copied directly
+        fixture.restore(memory_engine)      # an Engine, via sqlite3 backup
+
+    """
+
+    def __init__(self, template_path, build):
+        self.template_path = template_path
+        self.build = build
+
+    @property
+    def _fingerprint_path(self):
+        return self.template_path + ".build"
+
+    def _fingerprint(self):
+        code = getattr(self.build, '__code__', None)
+        if code is None:
+            return None
+        return hashlib.sha1(marshal.dumps(code)).hexdigest()
+
+    def _is_current(self):
+        if not os.path.exists(self.template_path):
+            return False
+        fingerprint = self._fingerprint()
+        if fingerprint is None:
+            return True
+        try:
+            with open(self._fingerprint_path) as fh:
+                return fh.read().strip() == fingerprint
+        except (IOError, OSError):
+            return False
+
+    def rebuild(self):
+        """Build the template database again from scratch."""
+
+        building = self.template_path + ".building"
+        if os.path.exists(building):
+            os.remove(building)
+        engine = create_engine("sqlite:///%s" % building)
+        try:
+            self.build(engine)
+        finally:
+            engine.dispose()
+        if os.path.exists(self.template_path):
+            os.remove(self.template_path)
+        os.rename(building, self.template_path)
+
+        fingerprint = self._fingerprint()
+        if fingerprint is not None:
+            with open(self._fingerprint_path, "w") as fh:
+                fh.write(fingerprint)
+
+    def restore(self, target):
+        """Reset ``target`` to the template's contents.
+
+        :param target: a filename, which is overwritten with a copy of
+         the template, or an Engine, whose database is replaced with
+         the sqlite3 backup API; the latter works for ``sqlite://``
+         in-memory databases and keeps pooled connections valid.
+
+        """
+        if not self._is_current():
+            self.rebuild()
+
+        if isinstance(target, Engine):
+            source = sqlite3.connect(self.template_path)
+            conn = target.raw_connection()
+            try:
+                source.backup(conn.connection)
+            finally:
+                conn.close()
+                source.close()
+        else:
+            shutil.copyfile(self.template_path, target)
+        return target
+
+
+class CompiledCache(object):
+    """A size-limited, least-recently-used ``compiled_cache``.
+
+    SQLAlchemy's Connection caches compiled statements in any dictionary
+    given as the ``compiled_cache`` execution option, keyed on the
+    statement construct along with the dialect and the INSERT/UPDATE
+    column names.  This provides that dictionary with a size limit and
+    statistics::
+
+        cache = CompiledCache(maxsize=100)
+        conn = engine.connect().execution_options(compiled_cache=cache)
+
+    As the construct itself is part of the key, a statement only benefits
+    if the same construct is executed again.  :meth:`statement` builds
+    each statement shape once, with :func:`.bindparam` standing in for
+    the literal values, which are then passed at execution time::
+
+        stmt = cache.statement("user_by_name", lambda:
+                    select([user_table]).
+                    where(user_table.c.username == bindparam('username')))
+        conn.execute(stmt, username='ed')
+
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._compiled = collections.OrderedDict()
+        self._statements = {}
+
+    def statement(self, key, build):
+        """Return the construct for ``key``, calling ``build()`` once."""
+
+        try:
+            return self._statements[key]
+        except KeyError:
+            stmt = self._statements[key] = build()
+            return stmt
+
+    def stats(self):
+        """Return hit, miss and eviction counts and the current size."""
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._compiled),
+            'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        self._compiled.clear()
+        self._statements.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __contains__(self, key):
+        return key in self._compiled
+
+    def __getitem__(self, key):
+        compiled = self._compiled.pop(key)
+        self._compiled[key] = compiled
+        self.hits += 1
+        return compiled
+
+    def __setitem__(self, key, compiled):
+        self.misses += 1
+        self._compiled.pop(key, None)
+        self._compiled[key] = compiled
+        while len(self._compiled) > self.maxsize:
+            self._compiled.popitem(last=False)
+            self.evictions += 1
+
+
+class MemoryBackend(object):
+    """In-process, least-recently-used storage for :class:`.ResultCache`."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+
+class DBMBackend(object):
+    """:mod:`dbm` file storage for :class:`.ResultCache`, which can be
+    shared between processes on the same host."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        db = dbm.open(self.path, 'c')
+        try:
+            if key not in db:
+                return None
+            return pickle.loads(db[key])
+        finally:
+            db.close()
+
+    def set(self, key, value):
+        db = dbm.open(self.path, 'c')
+        try:
+            db[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        finally:
+            db.close()
+
+    def delete(self, key):
+        db = dbm.open(self.path, 'c')
+        try:
+            if key in db:
+                del db[key]
+        finally:
+            db.close()
+
+
+def _table_names(stmt):
+    return set(t.name for t in find_tables(stmt, include_aliases=True)
+               if isinstance(t, Table))
+
+
+class ResultCache(object):
+    """Cache SELECT results, keyed on the SQL string and its parameters.
+
+    Each entry remembers the tables its statement reads from.  Calling
+    :meth:`invalidate` for a table, which :meth:`watch_engine` does for
+    INSERT, UPDATE and DELETE constructs, makes every entry reading that
+    table stale.  Entries also expire after ``ttl`` seconds, if given::
+
+        cache = ResultCache(MemoryBackend(), ttl=300)
+        cache.watch_engine(engine)
+
+        rows = cache.execute(conn, username_plus_count)
+
+    Only the tables of DML constructs are seen by :meth:`watch_engine`;
+    writes made with textual SQL need an explicit :meth:`invalidate`.
+    ``ormtools`` extends this to Query and the Session.
+
+    """
+
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = self.misses = self.expirations = self.invalidations = 0
+
+    def key_for(self, stmt, params=None, dialect=None):
+        compiled = stmt.compile(dialect=dialect)
+        values = compiled.construct_params(params or {})
+        return hashlib.sha1(
+                    ("%s\n%r" % (compiled, sorted(values.items()))).
+                    encode('utf-8')).hexdigest()
+
+    def _generation(self, table):
+        return self.backend.get("generation:%s" % table) or 0
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None if there isn't
+        a fresh one."""
+
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        created, generations, value = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self.expirations += 1
+        elif any(self._generation(table) != generation
+                    for table, generation in generations.items()):
+            self.invalidations += 1
+        else:
+            self.hits += 1
+            return value
+        self.misses += 1
+        self.backend.delete(key)
+        return None
+
+    def set(self, key, value, tables):
+        generations = dict((table, self._generation(table))
+                            for table in tables)
+        self.backend.set(key, (time.time(), generations, value))
+
+    def invalidate(self, *tables):
+        """Make all entries which read from the given tables stale."""
+
+        for table in tables:
+            if isinstance(table, Table):
+                table = table.name
+            self.backend.set("generation:%s" % table,
+                                self._generation(table) + 1)
+
+    def execute(self, connectable, stmt, **params):
+        """Execute a select() and return its rows as a list, from the
+        cache when possible."""
+
+        key = self.key_for(stmt, params, connectable.dialect)
+        rows = self.get(key)
+        if rows is None:
+            rows = connectable.execute(stmt, **params).fetchall()
+            self.set(key, rows, _table_names(stmt))
+        return rows
+
+    def watch_engine(self, engine):
+        """Invalidate tables written to by insert(), update() and delete()
+        constructs executed on ``engine``.
+
+        Tables are invalidated when the statement runs, and again when
+        its transaction commits, in case another connection cached the
+        old rows in the meantime.
+
+        """
+        written = weakref.WeakKeyDictionary()
+
+        def after_execute(conn, clauseelement, multiparams, params, result):
+            if isinstance(clauseelement, UpdateBase):
+                self.invalidate(clauseelement.table)
+                written.setdefault(conn, set()).add(clauseelement.table)
+
+        def commit(conn):
+            self.invalidate(*written.pop(conn, ()))
+
+        def rollback(conn):
+            written.pop(conn, None)
+
+        event.listen(engine, "after_execute", after_execute)
+        event.listen(engine, "commit", commit)
+        event.listen(engine, "rollback", rollback)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+        }
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": [value.year, value.month, value.day,
+                             value.hour, value.minute, value.second,
+                             value.microsecond]}
+    if isinstance(value, datetime.date):
+        return {"date": [value.year, value.month, value.day]}
+    if isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    raise TypeError("Can't put %r in a keyset cursor" % (value, ))
+
+
+def _decode_value(obj):
+    if "datetime" in obj:
+        return datetime.datetime(*obj["datetime"])
+    if "date" in obj:
+        return datetime.date(*obj["date"])
+    if "decimal" in obj:
+        return decimal.Decimal(obj["decimal"])
+    return obj
+
+
+def encode_cursor(values):
+    """Encode key values as an opaque, URL-safe keyset cursor.
+
+    Besides strings, numbers and None, values may be naive datetimes,
+    dates and Decimals; anything else raises TypeError.
+
+    """
+    return base64.urlsafe_b64encode(
+                json.dumps(list(values), default=_encode_value).
+                encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(
+                                cursor.encode('ascii')).decode('utf-8'),
+                      object_hook=_decode_value)
+
+
+def _keyset_columns(order_by):
+    """Split ``col`` / ``col.desc()`` into (column, descending) pairs."""
+
+    columns = []
+    for clause in order_by:
+        if isinstance(clause, UnaryExpression) and \
+                clause.modifier in (operators.desc_op, operators.asc_op):
+            columns.append((clause.element,
+                            clause.modifier is operators.desc_op))
+        else:
+            columns.append((clause, False))
+    return columns
+
+
+def keyset_criterion(order_by, values):
+    """Return WHERE criteria selecting rows after ``values`` in the
+    given ordering.
+
+    For ``order_by=(story_id, version_id)`` this is::
+
+        story_id > :a OR (story_id = :a AND version_id > :b)
+
+    which, unlike OFFSET, an index on the ordering columns can satisfy
+    directly, however deep the page.
+
+    """
+    columns = _keyset_columns(order_by)
+    if len(values) != len(columns):
+        raise ValueError("Cursor has %d values, ordering has %d columns" %
+                            (len(values), len(columns)))
+    clauses = []
+    for i, (col, descending) in enumerate(columns):
+        equal = [c == v for (c, d), v in zip(columns[0:i], values[0:i])]
+        if descending:
+            beyond = col < values[i]
+        else:
+            beyond = col > values[i]
+        clauses.append(and_(*(equal + [beyond])))
+    return or_(*clauses)
+
+
+def keyset_select(stmt, order_by, cursor=None, page_size=50):
+    """Apply keyset pagination to a select().
+
+    ``order_by`` is a sequence of columns, each optionally with
+    ``.desc()``, which together must be unique - typically ending with
+    the primary key.  ``cursor`` is the value returned along with the
+    previous page, or None for the first page.  Any ordering ``stmt``
+    already has is replaced, since the cursor only follows
+    ``order_by``.
+
+    """
+    if cursor is not None:
+        stmt = stmt.where(keyset_criterion(order_by, decode_cursor(cursor)))
+    return stmt.order_by(None).order_by(*order_by).limit(page_size)
+
+
+def keyset_page(connectable, stmt, order_by, cursor=None, page_size=50):
+    """Execute one page of a select(), using keyset pagination.
+
+    Returns ``(rows, next_cursor)``; ``next_cursor`` is None once the
+    last page has been reached.  The ``order_by`` columns need to be
+    among the columns selected.
+
+    """
+    rows = connectable.execute(
+                keyset_select(stmt, order_by, cursor, page_size)).fetchall()
+    if len(rows) < page_size:
+        return rows, None
+    last = rows[-1]
+    return rows, encode_cursor(
+                    [last[col] for col, descending in
+                        _keyset_columns(order_by)])
+
+
+def _index_prefixes(table):
+    """Yield the leading column lists that can serve lookups on
+    ``table``: those of the primary key, unique constraints and
+    indexes."""
+
+    if table.primary_key.columns:
+        yield list(table.primary_key.columns)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            yield list(constraint.columns)
+    for index in table.indexes:
+        yield list(index.columns)
+    for column in table.columns:
+        if column.index or column.unique:
+            yield [column]
+
+
+def unindexed_foreign_keys(metadata):
+    """Return ``(table, columns)`` for each foreign key in ``metadata``
+    whose columns aren't the leading columns of some index.
+
+    Without such an index, joining from the parent or loading a
+    one-to-many collection scans the whole child table.  A foreign
+    key is left out if any of its columns has
+    ``info={'index_fk': False}``.
+
+    """
+    found = []
+    for table in metadata.sorted_tables:
+        prefixes = list(_index_prefixes(table))
+        for constraint in table.constraints:
+            if not isinstance(constraint, ForeignKeyConstraint):
+                continue
+            columns = [fk.parent for fk in constraint.elements]
+            if any(col.info.get('index_fk', True) is False
+                   for col in columns):
+                continue
+            wanted = set(columns)
+            if any(set(prefix[0:len(columns)]) == wanted
+                   for prefix in prefixes):
+                continue
+            found.append((table, columns))
+    return found
+
+
+def index_foreign_keys(metadata, report=False):
+    """Add an Index to ``metadata`` for each unindexed foreign key.
+
+    The indexes are named ``ix_<table>_<columns>`` and are created by
+    the next create_all() along with their tables.  Returns the new
+    Index objects; with ``report=True`` each is also printed.
+
+    """
+    indexes = []
+    for table, columns in unindexed_foreign_keys(metadata):
+        name = "ix_%s_%s" % (table.name,
+                             "_".join(col.name for col in columns))
+        index = Index(name, *columns)
+        if report:
+            print("%% Adding index %s on %s(%s)" % (
+                    name, table.name,
+                    ", ".join(col.name for col in columns)))
+        indexes.append(index)
+    return indexes
+
+
+def auto_index_foreign_keys(metadata, report=False):
+    """Run index_foreign_keys() at the start of every create_all().
+
+    Tables added to ``metadata`` after this call are covered as well;
+    tables that create_all() finds already exist are left alone.
+
+    """
+    def before_create(target, connection, **kw):
+        index_foreign_keys(target, report=report)
+    event.listen(metadata, "before_create", before_create)
+    return metadata
+
+
+def existing_tables(connectable, tables):
+    """Return the set of ``(schema, name)`` among ``tables`` that exist.
+
+    Each schema's table names are read in one query - for SQLite, a
+    single read of sqlite_master - rather than one has_table() check
+    per table.
+
+    """
+    names = {}
+    for schema in set(table.schema for table in tables):
+        names[schema] = set(name.lower() for name in
+                connectable.dialect.get_table_names(connectable,
+                                                    schema=schema))
+    return set((table.schema, table.name) for table in tables
+               if table.name.lower() in names[table.schema])
+
+
+def create_all(metadata, bind, tables=None):
+    """Like ``metadata.create_all(bind)``, with one existence check per
+    schema instead of one per table."""
+
+    if tables is None:
+        tables = metadata.sorted_tables
+    with _begin(bind) as conn:
+        existing = existing_tables(conn, tables)
+        metadata.create_all(conn, checkfirst=False,
+                            tables=[table for table in tables
+                                    if (table.schema, table.name)
+                                    not in existing])
+
+
+def drop_all(metadata, bind, tables=None):
+    """Like ``metadata.drop_all(bind)``, with one existence check per
+    schema instead of one per table."""
+
+    if tables is None:
+        tables = metadata.sorted_tables
+    with _begin(bind) as conn:
+        existing = existing_tables(conn, tables)
+        metadata.drop_all(conn, checkfirst=False,
+                          tables=[table for table in tables
+                                  if (table.schema, table.name) in existing])
+
+
+class InValues(ColumnElement):
+    """``column IN (values)``, where the values travel as a single
+    parameter once there are more than ``threshold`` of them.
+
+    Use in_values() to create one.
+
+    """
+    __visit_name__ = 'in_values'
+
+    type = Boolean()
+
+    def __init__(self, column, values, threshold):
+        if hasattr(column, '__clause_element__'):
+            column = column.__clause_element__()
+        self.column = column
+        self.values = list(values)
+        self.threshold = threshold
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.column = clone(self.column, **kw)
+
+    def get_children(self, **kwargs):
+        return self.column,
+
+
+def in_values(column, values, threshold=500):
+    """Return ``column IN (values)`` suited to long lists of values.
+
+    Up to ``threshold`` values, this renders the same as
+    ``column.in_(values)``.  Beyond that, SQLite gets
+    ``column IN (SELECT value FROM json_each(?))`` and PostgreSQL
+    ``column = ANY(:values)``, each with the whole list as one
+    parameter, so there's no limit on the number of values and the
+    statement text doesn't depend on it; other backends get the values
+    split into several IN lists.
+
+    ``column`` may be a Table column or an ORM attribute such as
+    ``User.name``::
+
+        session.query(User).filter(in_values(User.name, names))
+
+    """
+    return InValues(column, values, threshold)
+
+
+def _in_bind(element, value):
+    return bindparam(None, value, type_=element.column.type, unique=True)
+
+
+@compiles(InValues)
+def _compile_in_values(element, compiler, **kw):
+    column = compiler.process(element.column, **kw)
+    if not element.values:
+        return "%s != %s" % (column, column)
+
+    lists = []
+    for chunk in chunks(element.values, element.threshold):
+        lists.append("%s IN (%s)" % (column, ", ".join(
+                        compiler.process(_in_bind(element, value), **kw)
+                        for value in chunk)))
+    if len(lists) == 1:
+        return lists[0]
+    return "(%s)" % " OR ".join(lists)
+
+
+@compiles(InValues, 'sqlite')
+def _compile_in_values_sqlite(element, compiler, **kw):
+    if len(element.values) <= element.threshold:
+        return _compile_in_values(element, compiler, **kw)
+
+    # json_each() hands back JSON scalars; convert the values to their
+    # database form first, as a normal bind parameter would.
+    process = element.column.type.dialect_impl(compiler.dialect).\
+                            bind_processor(compiler.dialect)
+    values = element.values
+    if process is not None:
+        values = [process(value) for value in values]
+    return "%s IN (SELECT value FROM json_each(%s))" % (
+                compiler.process(element.column, **kw),
+                compiler.process(
+                    bindparam(None, json.dumps(values), unique=True), **kw))
+
+
+@compiles(InValues, 'postgresql')
+def _compile_in_values_postgresql(element, compiler, **kw):
+    if len(element.values) <= element.threshold:
+        return _compile_in_values(element, compiler, **kw)
+
+    return "%s = ANY(%s)" % (
+                compiler.process(element.column, **kw),
+                compiler.process(
+                    bindparam(None, element.values, unique=True), **kw))
@@ -0,0 +1,1023 @@
+"""Helpers for working with the ORM at larger data volumes than
+the tutorial slides use.
+
+"""
+import collections
+import copy
+import itertools
+import os
+import pickle
+import sys
+import traceback
+import warnings
+import weakref
+
+from sqlalchemy import Table, event, func, select
+from sqlalchemy import exc as sa_exc
+from sqlalchemy import inspect
+from sqlalchemy.orm import Mapper
+from sqlalchemy.orm import Query as _Query
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import attributes
+from sqlalchemy.orm import configure_mappers, relationship
+from sqlalchemy.orm import exc as orm_exc
+from sqlalchemy.orm import strategies
+from sqlalchemy.orm.identity import WeakInstanceDict
+from sqlalchemy.orm.interfaces import ONETOMANY
+from sqlalchemy.util import KeyedTuple
+
+from coretools import CompiledCache, chunks, _table_names, \
+                encode_cursor, decode_cursor, keyset_criterion, \
+                _keyset_columns, in_values
+
+
+class Query(_Query):
+    """Query with additional loading techniques.
+
+    Use it by passing ``query_cls=Query`` to the Session::
+
+        session = Session(bind=engine, query_cls=Query)
+
+    """
+
+    _selectin = ()
+    _result_cache = None
+
+    def selectinload(self, attr, chunk_size=500):
+        """Load ``attr`` for all results with IN, once the parent rows
+        are loaded.
+
+        The primary keys (or foreign keys, for many-to-one) of the
+        loaded objects are collected and the related rows SELECTed using
+        ``WHERE <col> IN (...)``, ``chunk_size`` keys at a time.  Unlike
+        subqueryload(), the parent query isn't run a second time, and
+        unlike joinedload(), parent rows aren't repeated for each child.
+
+        All results are fetched before any are returned.
+
+        """
+        q = self._clone()
+        q._selectin = self._selectin + ((attr, chunk_size),)
+        return q
+
+    def from_cache(self, cache):
+        """Return results from a :class:`.ResultCache` when possible.
+
+        Results are stored pickled, and merged into the Session without
+        a load when they're returned.  Use :func:`.watch_session` so
+        that flushes invalidate the tables they write to.  While new or
+        changed objects in the Session haven't been flushed, as with
+        autoflush off, queries against their tables skip the cache.
+
+        """
+        q = self._clone()
+        q._result_cache = cache
+        return q
+
+    def keyset_page(self, order_by, cursor=None, page_size=50):
+        """Return one page of results using keyset pagination.
+
+        Rather than OFFSET, the page starts after the ordering key values
+        of the previous page's last row, carried in ``cursor``::
+
+            users, cursor = query.keyset_page([User.id])
+            while cursor:
+                users, cursor = query.keyset_page([User.id], cursor)
+
+        ``order_by`` must identify rows uniquely; a composite key such as
+        ``[Story.story_id, Story.version_id]`` works too, as does
+        ``.desc()``.  Returns ``(results, next_cursor)``, with
+        ``next_cursor`` None on the last page.  Any ordering the query
+        already has is replaced by ``order_by``.
+
+        """
+        columns = [col for col, descending in _keyset_columns(order_by)]
+        q = self
+        if cursor is not None:
+            q = q.filter(keyset_criterion(order_by, decode_cursor(cursor)))
+        q = q.order_by(None).order_by(*order_by).\
+                add_columns(*columns).limit(page_size)
+
+        rows = list(q)
+        width = len(self._entities)
+        if width == 1:
+            results = [row[0] for row in rows]
+        else:
+            results = [KeyedTuple(row[0:width], row.keys()[0:width])
+                        for row in rows]
+        if len(rows) < page_size:
+            return results, None
+        return results, encode_cursor(rows[-1][width:])
+
+    def __iter__(self):
+        if self._result_cache is not None:
+            return self._iter_cached()
+        if not self._selectin:
+            return _Query.__iter__(self)
+
+        rows = list(_Query.__iter__(self))
+        for attr, chunk_size in self._selectin:
+            cls = attr.property.parent.class_
+            instances = []
+            for row in rows:
+                for obj in isinstance(row, tuple) and row or (row, ):
+                    if isinstance(obj, cls):
+                        instances.append(obj)
+            load_selectin(self.session, instances, attr, chunk_size)
+        return iter(rows)
+
+    def _iter_cached(self):
+        # flush first, as Query.__iter__ would, so that watch_session()
+        # invalidates whatever the flush writes before the lookup
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+
+        cache = self._result_cache
+        stmt = self.statement
+        tables = _table_names(stmt)
+        q = self._clone()
+        q._result_cache = None
+        if self._has_pending_changes(tables):
+            # merging cached rows would overwrite the unflushed changes
+            return iter(q)
+
+        key = cache.key_for(stmt, self._params,
+                        self.session.get_bind(self._mapper_zero_or_none()).
+                        dialect)
+        cached = cache.get(key)
+        if cached is None:
+            rows = list(q)
+            cache.set(key, pickle.dumps(rows, pickle.HIGHEST_PROTOCOL),
+                        tables)
+            return iter(rows)
+        return self.merge_result(pickle.loads(cached), load=False)
+
+    def _has_pending_changes(self, tables):
+        for obj in itertools.chain(self.session.new, self.session.dirty):
+            if any(table.name in tables
+                   for table in inspect(obj).mapper.tables):
+                return True
+        return False
+
+
+def watch_session(cache, session):
+    """Invalidate the tables a Session writes to in a
+    :class:`.ResultCache`.
+
+    Tables are invalidated when the flush happens, so the same Session
+    doesn't read stale results, and again on commit, in case another
+    Session cached the old rows in the meantime.  ``session`` may also
+    be a Session class or sessionmaker.
+
+    """
+    written = weakref.WeakKeyDictionary()
+
+    def after_flush(session, flush_context):
+        tables = set()
+        for obj in list(session.new) + list(session.dirty) + \
+                    list(session.deleted):
+            tables.update(t.name for t in inspect(obj).mapper.tables)
+        cache.invalidate(*tables)
+        written.setdefault(session, set()).update(tables)
+
+    def after_commit(session):
+        cache.invalidate(*written.pop(session, ()))
+
+    def after_soft_rollback(session, previous_transaction):
+        written.pop(session, None)
+
+    event.listen(session, "after_flush", after_flush)
+    event.listen(session, "after_commit", after_commit)
+    event.listen(session, "after_soft_rollback", after_soft_rollback)
+
+
+def stream(query, batch_size=1000, release=True):
+    """Iterate a Query, building objects ``batch_size`` rows at a time.
+
+    This uses :meth:`.Query.yield_per`, so the same cautions apply - in
+    particular, eager loading of collections doesn't mix with it.  With
+    ``release``, each batch of objects is expunged from the Session
+    once the caller has moved on to the next batch, so that the
+    identity map doesn't grow with the result; objects with pending
+    changes are kept.
+
+    """
+    session = query.session
+    batch = []
+    for row in query.yield_per(batch_size):
+        yield row
+        if release:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                _release(session, batch)
+                batch = []
+    if batch:
+        _release(session, batch)
+
+
+def _release(session, rows):
+    for row in rows:
+        for obj in isinstance(row, tuple) and row or (row, ):
+            state = inspect(obj, raiseerr=False)
+            if getattr(state, 'persistent', False) and \
+                    not state.modified and obj in session:
+                session.expunge(obj)
+
+
+def load_selectin(session, instances, attr, chunk_size=500):
+    """Load the relationship ``attr`` for each of ``instances`` using
+    SELECTs with ``IN``, ``chunk_size`` keys at a time.
+
+    Instances where ``attr`` is already loaded are left alone.  Only
+    relationships joined on a single column pair without a secondary
+    table are supported.
+
+    """
+    prop = attr.property
+    if prop.secondary is not None or len(prop.local_remote_pairs) != 1:
+        raise sa_exc.InvalidRequestError(
+            "load_selectin() supports only relationships joined on a "
+            "single column pair, not %s" % prop)
+    local_col, remote_col = prop.local_remote_pairs[0]
+    local_key = prop.parent.get_property_by_column(local_col).key
+
+    by_key = {}
+    for obj in instances:
+        if prop.key in attributes.instance_dict(obj):
+            continue
+        by_key.setdefault(getattr(obj, local_key), []).append(obj)
+    keys = [key for key in by_key if key is not None]
+
+    loaded = dict((key, []) for key in by_key)
+    q = session.query(prop.mapper, remote_col)
+    if prop.order_by:
+        q = q.order_by(*prop.order_by)
+    for chunk in chunks(keys, chunk_size):
+        for related, key in q.filter(remote_col.in_(chunk)):
+            loaded[key].append(related)
+
+    for key, objs in by_key.items():
+        for obj in objs:
+            if prop.uselist:
+                related = list(loaded[key])
+            else:
+                related = loaded[key] and loaded[key][0] or None
+            attributes.set_committed_value(obj, prop.key, related)
+
+
+class BakedQuery(object):
+    """A Query that's constructed and compiled once, then run many
+    times with different parameters.
+
+    ``build`` receives a Session and returns a Query, using
+    :func:`.bindparam` for the values which vary::
+
+        user_by_name = BakedQuery(lambda session:
+                            session.query(User).
+                            filter(User.name == bindparam('name')))
+
+        user_by_name(session, name='ed').one()
+
+    The Query's generative steps and its QueryContext are produced only on
+    first use; each call after that copies the context, and the SQL string
+    comes out of :attr:`compiled_cache`.  Options which change the query
+    from call to call don't belong in ``build``.
+
+    """
+
+    def __init__(self, build, cache_size=10):
+        self.build = build
+        self.compiled_cache = CompiledCache(cache_size)
+        self._baked = {}
+
+    def __call__(self, session, **params):
+        return BakedResult(self, session, params)
+
+    def _bake(self, session, variant):
+        try:
+            return self._baked[variant]
+        except KeyError:
+            query = self.build(session)
+            if variant == 'first':
+                query = query.limit(1)
+            query = query.execution_options(
+                                compiled_cache=self.compiled_cache)
+            context = query._compile_context()
+            context.statement.use_labels = True
+            query.session = context.session = None
+            baked = self._baked[variant] = (query, context)
+            return baked
+
+
+class BakedResult(object):
+    """The result of calling a :class:`.BakedQuery`, providing the
+    usual Query methods for getting at rows."""
+
+    def __init__(self, baked, session, params):
+        self.baked = baked
+        self.session = session
+        self.params = params
+
+    def _execute(self, variant=None):
+        query, context = self.baked._bake(self.session, variant)
+
+        query = query._clone()
+        query.session = self.session
+        query._params = self.params
+
+        context = copy.copy(context)
+        context.query = query
+        context.session = self.session
+        context.attributes = context._attributes = \
+                                    dict(context.attributes)
+
+        if query._autoflush and not query._populate_existing:
+            self.session._autoflush()
+        return query._execute_and_instances(context)
+
+    def __iter__(self):
+        return iter(self._execute())
+
+    def all(self):
+        return list(self._execute())
+
+    def first(self):
+        for row in self._execute('first'):
+            return row
+        return None
+
+    def one(self):
+        rows = list(self._execute())
+        if not rows:
+            raise orm_exc.NoResultFound("No row was found for one()")
+        elif len(rows) > 1:
+            raise orm_exc.MultipleResultsFound(
+                "Multiple rows were found for one()")
+        return rows[0]
+
+
+def _bulk_table(mapper):
+    if len(mapper.tables) > 1:
+        raise sa_exc.InvalidRequestError(
+            "Bulk INSERT of %s isn't supported; it's mapped to more "
+            "than one table" % mapper)
+    return mapper.local_table
+
+
+def _bulk_insert(session, mapper, records, return_defaults, chunk_size):
+    """INSERT (attribute dict, callback) records for one mapper."""
+
+    table = _bulk_table(mapper)
+    columns = [(prop.key, prop.columns[0])
+                for prop in mapper.column_attrs
+                if prop.columns[0].table is table]
+    pk_keys = [mapper.get_property_by_column(col).key
+                for col in mapper.primary_key]
+
+    conn = session.connection(mapper=mapper)
+    stmt = table.insert()
+
+    def params_for(record):
+        values = record[0]
+        return dict((col.key, values[key])
+                    for key, col in columns if key in values)
+
+    for chunk in chunks(records, chunk_size):
+        params = [(record, params_for(record)) for record in chunk]
+        for _, group in itertools.groupby(
+                            params, lambda param: sorted(param[1])):
+            group = list(group)
+            if not return_defaults:
+                conn.execute(stmt, [row for record, row in group])
+                continue
+
+            # the DBAPI only reports generated primary keys for
+            # single-row execute(), so rows missing them go one by one
+            missing = [(record, row) for record, row in group
+                        if any(record[0].get(key) is None
+                                for key in pk_keys)]
+            present = [row for record, row in group
+                        if not any(record[0].get(key) is None
+                                for key in pk_keys)]
+            if present:
+                conn.execute(stmt, present)
+            for (values, callback), row in missing:
+                result = conn.execute(stmt, row)
+                for key, value in zip(pk_keys, result.inserted_primary_key):
+                    values[key] = value
+                    if callback is not None:
+                        callback(key, value)
+
+
+def bulk_insert_mappings(session, mapper, mappings,
+                            return_defaults=False, chunk_size=1000):
+    """INSERT rows for a mapped class from plain dictionaries.
+
+    The dictionaries are keyed on mapped attribute names, e.g.
+    ``{"name": "ed", "fullname": "Ed Jones"}`` for ``User``.  Rows are
+    sent as executemany() INSERTs in the Session's current transaction,
+    one per run of dictionaries with the same keys; no objects are
+    created and nothing is added to the identity map.
+
+    If ``return_defaults`` is True, primary key values generated by the
+    database are written back into each dictionary.  That requires an
+    individual INSERT for each row lacking a primary key, so leave it
+    off unless the keys are needed.
+
+    """
+    mapper = inspect(mapper)
+    records = ((mapping, None) for mapping in mappings)
+    _bulk_insert(session, mapper, records, return_defaults, chunk_size)
+
+
+def bulk_save_objects(session, objects, return_defaults=False,
+                            chunk_size=1000):
+    """INSERT new mapped objects without the unit of work.
+
+    Consecutive objects of the same mapper are grouped together and
+    their column attributes INSERTed as with
+    :func:`.bulk_insert_mappings`.  Relationships, cascades and
+    attribute history are ignored, and the objects are *not* added to
+    the Session.
+
+    With ``return_defaults``, generated primary keys are set on
+    each object.  Objects whose primary key is then known are made
+    detached, with an identity key and no pending changes, so that
+    ``session.add()`` attaches them as persistent rather than
+    INSERTing them again; the others stay transient and should be
+    queried for instead.  If the transaction is rolled back, the
+    detached objects refer to rows that don't exist.
+
+    """
+    def records(group):
+        for obj in group:
+            def callback(key, value, obj=obj):
+                attributes.set_committed_value(obj, key, value)
+            yield attributes.instance_dict(obj), callback
+
+    for mapper, group in itertools.groupby(
+                        objects, lambda obj: inspect(obj).mapper):
+        group = list(group)
+        _bulk_insert(session, mapper, records(group),
+                        return_defaults, chunk_size)
+        for obj in group:
+            state = attributes.instance_state(obj)
+            key = mapper._identity_key_from_state(state)
+            if None not in key[1]:
+                state.key = key
+                state._commit_all(state.dict)
+
+
+def batch_inserts(session):
+    """Have ``session`` assign integer primary keys itself before each
+    flush, so that the flush can batch its INSERTs.
+
+    The unit of work already sends INSERTs for rows whose primary keys
+    are all present as one executemany(); it's only autoincrementing
+    keys, which have to be fetched after each single-row INSERT, that
+    make it go one row at a time.  Here, new objects with a single
+    autoincrement primary key that isn't set are numbered on from
+    ``max(id)`` - one SELECT per table per flush - before the flush
+    starts, so a User with a thousand new Address objects takes two
+    INSERT statements rather than a thousand and one.
+
+    Only tables on SQLite connections are numbered this way.  Elsewhere
+    the ids usually come from a sequence, which numbering from
+    ``max(id)`` wouldn't advance, so later ordinary INSERTs would
+    collide.  Even on SQLite the keys are chosen in the flush's
+    transaction but aren't reserved against other connections; use
+    this where one process writes to a table at a time.
+
+    ``session`` may be a Session, sessionmaker or Session subclass.
+
+    """
+    event.listen(session, "before_flush", _assign_primary_keys)
+    return session
+
+
+def _assign_primary_keys(session, flush_context, instances):
+    # keyed by column, as mappers inheriting a table share its ids
+    pending = collections.defaultdict(list)
+    explicit = {}
+    for obj in session.new:
+        state = attributes.instance_state(obj)
+        mapper = state.mapper
+        if len(mapper.primary_key) != 1:
+            continue
+        col = mapper.primary_key[0]
+        if col is not col.table._autoincrement_column:
+            continue
+        key = mapper.get_property_by_column(col).key
+        value = state.dict.get(key)
+        if value is None:
+            pending[col].append((state, mapper, key))
+        else:
+            explicit[col] = max(explicit.get(col, value), value)
+
+    for col, states in pending.items():
+        conn = session.connection(mapper=states[0][1])
+        if conn.dialect.name != 'sqlite':
+            continue
+        # number past ids given explicitly in this flush as well
+        next_id = max(conn.scalar(select([func.max(col)])) or 0,
+                      explicit.get(col, 0))
+        for state, mapper, key in sorted(
+                            states, key=lambda item: item[0].insert_order):
+            next_id += 1
+            setattr(state.obj(), key, next_id)
+
+
+_cascade_relationships = weakref.WeakSet()
+
+
+def cascade_relationship(argument, secondary=None, **kw):
+    """A one-to-many relationship() whose child rows are deleted by
+    the database's ON DELETE CASCADE.
+
+    This is ``relationship()`` with ``cascade="all, delete-orphan"``
+    and ``passive_deletes=True``: deleting a parent no longer loads
+    its unloaded children just to DELETE them one at a time, leaving
+    a single DELETE for the parent row.  The foreign keys the
+    relationship joins on are given ``ondelete="CASCADE"`` when their
+    table is created, so the database can do the rest; on SQLite, use
+    :func:`coretools.enable_sqlite_foreign_keys` as well.
+
+    Children already loaded into the Session are still deleted by the
+    unit of work, as with any ``passive_deletes`` relationship.
+
+    """
+    kw.setdefault('cascade', 'all, delete-orphan')
+    kw['passive_deletes'] = True
+    prop = relationship(argument, secondary, **kw)
+    _cascade_relationships.add(prop)
+    return prop
+
+
+def _add_on_delete_cascade(table, connection, **kw):
+    if not _cascade_relationships:
+        return
+    configure_mappers()
+    for prop in list(_cascade_relationships):
+        if getattr(prop, 'direction', None) is not ONETOMANY:
+            continue
+        for col in prop._calculated_foreign_keys:
+            if col.table is not table:
+                continue
+            for fk in col.foreign_keys:
+                if fk.column.table in prop.parent.tables:
+                    fk.ondelete = fk.constraint.ondelete = 'CASCADE'
+
+
+event.listen(Table, "before_create", _add_on_delete_cascade)
+
+
+class NPlusOneWarning(sa_exc.SAWarning):
+    """Emitted by :class:`.NPlusOneDetector` in "warn" mode."""
+
+
+class NPlusOneError(sa_exc.InvalidRequestError):
+    """Raised by :class:`.NPlusOneDetector` in "raise" mode."""
+
+
+class NPlusOneDetector(object):
+    """Watch for relationships lazy loading one at a time across the
+    objects of a single query result - the "N plus one" pattern::
+
+        with NPlusOneDetector(mode='warn') as detector:
+            for user in session.query(User):
+                print(user, user.addresses)
+        detector.report()
+
+    Once ``threshold`` lazy loads of the same relationship have come
+    from objects loaded by the same query, ``mode`` decides what
+    happens:
+
+    * ``"warn"`` - emit an :class:`.NPlusOneWarning` naming the
+      relationship and the line of code which triggered the load;
+    * ``"raise"`` - raise :class:`.NPlusOneError` instead of loading;
+    * ``"eager"`` - load the relationship for *all* objects from that
+      query at once using :func:`.load_selectin`, so the rest of the
+      loop doesn't lazy load at all.  In this mode the first lazy load
+      already triggers the batch.
+
+    In all modes, :attr:`records` counts the lazy loads seen per
+    relationship and call site.
+
+    """
+
+    def __init__(self, mode='warn', threshold=2, chunk_size=500):
+        if mode not in ('warn', 'raise', 'eager'):
+            raise ValueError("mode must be 'warn', 'raise' or 'eager'")
+        self.mode = mode
+        self.threshold = mode == 'eager' and 1 or threshold
+        self.chunk_size = chunk_size
+        self.records = {}
+
+    def install(self):
+        _install_nplusone_hooks()
+        _nplusone_detectors.append(self)
+        return self
+
+    def uninstall(self):
+        _nplusone_detectors.remove(self)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, type_, value, traceback):
+        self.uninstall()
+
+    def report(self):
+        """Print the relationships which were lazy loaded repeatedly."""
+
+        if not self.records:
+            print("% No N+1 lazy loads detected.")
+            return
+        for (prop, site), count in sorted(self.records.items(),
+                                        key=lambda item: -item[1]):
+            print("%6d lazy loads of %s at %s" % (count, prop, site))
+
+    def _lazyload(self, prop, session, state, site):
+        group = _nplusone_groups.get(state.obj())
+        if group is None:
+            return None
+        count = group.counts[prop] = group.counts.get(prop, 0) + 1
+        self.records[(str(prop), site)] = \
+                            self.records.get((str(prop), site), 0) + 1
+
+        if count < self.threshold or len(group.instances) < 2:
+            return None
+        message = "N+1 lazy load: %s loaded one at a time for %d of " \
+                    "the %d objects from one query, at %s" % (
+                    prop, count, len(group.instances), site)
+        if self.mode == 'warn':
+            if count == self.threshold:
+                warnings.warn(message, NPlusOneWarning)
+        elif self.mode == 'raise':
+            raise NPlusOneError(message)
+        elif self.mode == 'eager' and prop.secondary is None and \
+                len(prop.local_remote_pairs) == 1:
+            instances = [obj for obj in list(group.instances)
+                            if isinstance(obj, prop.parent.class_)]
+            load_selectin(session, instances,
+                            getattr(prop.parent.class_, prop.key),
+                            self.chunk_size)
+            return (state.dict[prop.key], )
+        return None
+
+
+class _LoadGroup(object):
+    """The objects loaded by one query execution."""
+
+    def __init__(self):
+        self.instances = weakref.WeakSet()
+        self.counts = {}
+
+
+_nplusone_detectors = []
+_nplusone_groups = weakref.WeakKeyDictionary()
+
+
+def _nplusone_call_site():
+    here = os.path.splitext(os.path.abspath(__file__))[0]
+    for filename, lineno, name, text in reversed(traceback.extract_stack()):
+        path = os.path.splitext(os.path.abspath(filename))[0]
+        if path == here or \
+                (os.sep + "sqlalchemy" + os.sep) in filename:
+            continue
+        return "%s:%s in %s" % (filename, lineno, name)
+    return "<unknown>"
+
+
+def _install_nplusone_hooks():
+    if getattr(strategies.LazyLoader, '_nplusone_hooked', False):
+        return
+
+    def track(state, context, *arg):
+        if not _nplusone_detectors:
+            return
+        group = context.attributes.get('_nplusone_group')
+        if group is None:
+            group = context.attributes['_nplusone_group'] = _LoadGroup()
+        group.instances.add(state.obj())
+        _nplusone_groups[state.obj()] = group
+
+    event.listen(Mapper, 'load', track, raw=True)
+    event.listen(Mapper, 'refresh', track, raw=True)
+
+    emit_lazyload = strategies.LazyLoader._emit_lazyload
+
+    def _emit_lazyload(self, session, state, ident_key, passive):
+        if _nplusone_detectors:
+            site = _nplusone_call_site()
+            for detector in list(_nplusone_detectors):
+                loaded = detector._lazyload(
+                            self.parent_property, session, state, site)
+                if loaded is not None:
+                    value = loaded[0]
+                    if self.uselist:
+                        value = list(value)
+                    return value
+        return emit_lazyload(self, session, state, ident_key, passive)
+
+    strategies.LazyLoader._emit_lazyload = _emit_lazyload
+    strategies.LazyLoader._nplusone_hooked = True
+
+
+# PyPy and other interpreters without reference counts don't have it
+_HAS_REFCOUNT = hasattr(sys, 'getrefcount')
+
+
+def _strong_refs(ref):
+    """Return the reference count of the object behind weakref ``ref``.
+
+    Without sys.getrefcount(), a live object is reported as referenced
+    from everywhere, so LRUInstanceDict never expunges it.
+
+    """
+
+    obj = ref()
+    if obj is None:
+        return 0
+    elif not _HAS_REFCOUNT:
+        return sys.maxsize
+    return sys.getrefcount(obj)
+
+
+class _Probe(object):
+    pass
+
+
+def _refcount_base():
+    if not _HAS_REFCOUNT:
+        return 0
+    probe = _Probe()
+    return _strong_refs(weakref.ref(probe)) - 1
+
+
+# what _strong_refs() reports for an object nothing else refers to
+_REFCOUNT_BASE = _refcount_base()
+
+
+def _members(value):
+    """Yield the mapped instances an attribute value refers to."""
+
+    if hasattr(value, '_sa_instance_state'):
+        yield value
+    elif isinstance(value, (list, set, frozenset, tuple)):
+        for member in value:
+            if hasattr(member, '_sa_instance_state'):
+                yield member
+    elif isinstance(value, dict):
+        for member in value.values():
+            if hasattr(member, '_sa_instance_state'):
+                yield member
+
+
+class LRUInstanceDict(WeakInstanceDict):
+    """An identity map which expunges the least recently used clean,
+    unreferenced objects from its Session once it holds more than
+    ``maxsize``.
+
+    Objects count as used when they're loaded, flushed, or looked up by
+    identity, as with ``query.get()`` or a many-to-one lazy load.
+    Objects with pending changes, objects marked deleted, and objects
+    that anything outside the Session refers to - including, directly
+    or through relationships, the rows of a result still being loaded
+    or worked with - are never expunged.  What's left are objects only
+    kept alive by references among themselves, such as backrefs, which
+    would otherwise wait for the garbage collector.
+
+    Each pass over the map expunges down to nine tenths of ``maxsize``.
+    If it can't get below ``maxsize``, the next pass waits until the
+    map has grown by another tenth.
+
+    Telling unreferenced objects apart relies on CPython's reference
+    counts via sys.getrefcount().  Interpreters without it, such as
+    PyPy, never expunge anything, and the map grows like a plain
+    WeakInstanceDict.
+
+    """
+
+    def __init__(self, session, maxsize):
+        WeakInstanceDict.__init__(self)
+        self._session = weakref.ref(session)
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._lru = collections.OrderedDict()
+        self._next_check = 0
+
+    def _touch(self, key):
+        self._lru.pop(key, None)
+        self._lru[key] = True
+
+    def __getitem__(self, key):
+        obj = WeakInstanceDict.__getitem__(self, key)
+        self._touch(key)
+        return obj
+
+    def get(self, key, default=None):
+        obj = WeakInstanceDict.get(self, key, default)
+        if obj is not default:
+            self._touch(key)
+        return obj
+
+    def add(self, state):
+        WeakInstanceDict.add(self, state)
+        self._touch(state.key)
+        self._check_size()
+
+    def replace(self, state):
+        WeakInstanceDict.replace(self, state)
+        self._touch(state.key)
+        self._check_size()
+
+    def discard(self, state):
+        if dict.get(self, state.key, None) is state:
+            self._lru.pop(state.key, None)
+        WeakInstanceDict.discard(self, state)
+
+    def _check_size(self):
+        if len(self._lru) > max(self.maxsize, self._next_check):
+            self._evict()
+            if len(self._lru) > self.maxsize:
+                self._next_check = len(self._lru) + \
+                                    max(1, self.maxsize // 10)
+            else:
+                self._next_check = 0
+
+    def _references(self):
+        """Return, for each state in the map, the number of references
+        to its object from other objects in the map, and the states
+        each one refers to."""
+
+        internal = collections.defaultdict(int)
+        edges = {}
+        for state in list(dict.values(self)):
+            targets = edges[state] = []
+            obj = state.obj()
+            if obj is None:
+                continue
+            for value in list(attributes.instance_dict(obj).values()):
+                for member in _members(value):
+                    target = attributes.instance_state(member)
+                    if target.key is not None and \
+                            dict.get(self, target.key, None) is target:
+                        internal[target] += 1
+                        targets.append(target)
+            del obj
+        return internal, edges
+
+    def _evict(self):
+        session = self._session()
+        deleted = session is not None and session._deleted or {}
+        internal, edges = self._references()
+
+        # anything referenced from outside the map, or with changes,
+        # keeps itself and everything it refers to in the Session
+        keep = set()
+        stack = [state for state in edges
+                    if state.modified or state in deleted or
+                        _strong_refs(state.obj) - _REFCOUNT_BASE >
+                            internal[state]]
+        while stack:
+            state = stack.pop()
+            if state not in keep:
+                keep.add(state)
+                stack.extend(edges[state])
+
+        target = self.maxsize - self.maxsize // 10
+        victims = []
+        for key in list(self._lru):
+            if len(self._lru) - len(victims) <= target:
+                break
+            state = dict.get(self, key, None)
+            if state is None or state.obj() is None:
+                # already garbage collected
+                self._lru.pop(key)
+            elif state not in keep:
+                victims.append(state)
+
+        for state in victims:
+            self.evictions += 1
+            if session is not None:
+                session._expunge_state(state)
+            else:
+                self.discard(state)
+
+    def stats(self):
+        return {
+            'size': len(self._lru),
+            'maxsize': self.maxsize,
+            'evictions': self.evictions,
+        }
+
+
+class BoundedSession(Session):
+    """A Session whose identity map is an :class:`.LRUInstanceDict`.
+
+    ::
+
+        session = BoundedSession(bind=engine, identity_map_size=10000)
+
+    Only objects nothing outside the Session refers to are expunged, so
+    the objects a caller holds stay attached however large the result;
+    the map is kept to ``identity_map_size`` once they're let go.
+
+    """
+
+    def __init__(self, bind=None, identity_map_size=10000, **kw):
+        Session.__init__(self, bind=bind, **kw)
+        session = weakref.ref(self)
+        self._identity_cls = lambda: LRUInstanceDict(session(),
+                                                     identity_map_size)
+        self.identity_map = self._identity_cls()
+
+
+def expire_written(session, check_versions=False):
+    """Expire only what a transaction wrote when it commits.
+
+    By default, commit expires every object in the Session, so the
+    next access to each one runs a SELECT even if this transaction
+    never touched it.  With this, ``expire_on_commit`` is turned off
+    and instead, after each commit, the attributes this transaction
+    changed on existing objects are expired, along with the whole of
+    any object it INSERTed, in case the database applied defaults,
+    triggers or type conversions; objects that were only read are
+    left as they are.
+
+    With ``check_versions``, objects that were only read and whose
+    mapper has a ``version_id_col`` are also checked against the
+    database just before the commit - one SELECT of primary key and
+    version per mapper - and expired entirely if their row changed
+    or went away.
+
+    ``session`` may also be a Session class or sessionmaker, created
+    with ``expire_on_commit=False``.
+
+    """
+    if isinstance(session, Session):
+        session.expire_on_commit = False
+    written = weakref.WeakKeyDictionary()
+    stale = weakref.WeakKeyDictionary()
+
+    def after_flush(session, flush_context):
+        states = written.setdefault(session, {})
+        for obj in session.new:
+            states[attributes.instance_state(obj)] = None
+        for obj in session.dirty:
+            state = attributes.instance_state(obj)
+            keys = states.setdefault(state, set())
+            if keys is not None:
+                keys.update(state.committed_state)
+
+    def before_commit(session):
+        if check_versions:
+            stale[session] = _stale_states(session,
+                                           written.get(session, {}))
+
+    def after_commit(session):
+        expire = list(written.pop(session, {}).items())
+        expire.extend((state, None) for state in stale.pop(session, ()))
+        for state, keys in expire:
+            obj = state.obj()
+            if obj is not None and obj in session:
+                session.expire(obj, keys and list(keys) or None)
+
+    def after_soft_rollback(session, previous_transaction):
+        written.pop(session, None)
+        stale.pop(session, None)
+
+    event.listen(session, "after_flush", after_flush)
+    event.listen(session, "before_commit", before_commit)
+    event.listen(session, "after_commit", after_commit)
+    event.listen(session, "after_soft_rollback", after_soft_rollback)
+    return session
+
+
+def _stale_states(session, written):
+    """Return the unmodified, versioned states in ``session`` whose
+    rows have a different version, or no row, in the database."""
+
+    loaded = collections.defaultdict(dict)
+    for state in session.identity_map.all_states():
+        mapper = state.mapper
+        if mapper.version_id_col is None or \
+                len(mapper.primary_key) != 1 or \
+                state in written or state.modified:
+            continue
+        version = mapper._get_state_attr_by_column(
+                        state, state.dict, mapper.version_id_col,
+                        passive=attributes.PASSIVE_NO_FETCH)
+        if version not in (None, attributes.PASSIVE_NO_RESULT):
+            loaded[mapper][state.key[1][0]] = (state, version)
+
+    stale = []
+    for mapper, states in loaded.items():
+        pk, version_col = mapper.primary_key[0], mapper.version_id_col
+        current = dict(session.connection(mapper=mapper).execute(
+                        select([pk, version_col]).
+                        where(in_values(pk, list(states)))).fetchall())
+        stale.extend(state for ident, (state, version) in states.items()
+                     if current.get(ident) != version)
+    return stale